@@ -1,61 +1,28 @@
 import click
-import nacl.secret
-import nacl.utils
-import nacl.hash
 import sys
-import zlib
-import base64
 
 from . import __version__
-
-def kdf(size, pwd):
-  """ Generate appropriate sized key from password """
-  return nacl.hash.blake2b(pwd, digest_size=size)[:size]
+from . import crypto
 
 def encrypt(fname, pwd):
-  # Read & gzip file
+  # Read file
   with open(fname, 'rb') as f:
     contents = f.read()
-    zipd = zlib.compress(contents)
-  
-  # Hash password to appropriate size key
-  pwdbytes = pwd.encode('utf-8')
-  key = kdf(nacl.secret.SecretBox.KEY_SIZE, pwdbytes)
-
-  # Encrypt
-  box = nacl.secret.SecretBox(key)
-  enc = box.encrypt(zipd)
   
-  # Base 64 encode
-  enc64 = base64.b64encode(enc).decode("ascii")
+  # Gzip & encrypt
+  enc = crypto.encrypt(contents, pwd)
   
   # Store the data
   outfname = fname+'.enc'
-  with open(outfname, 'w') as f:
-    f.write(enc64)
+  with open(outfname, 'wb') as f:
+    f.write(enc)
     
   return outfname
 
 def decrypt(fname, pwd):
-  # Read file
-  with open(fname, 'r') as f:
-    enc64 = f.read()
-  
-  # Base 64 decode
-  zipd = base64.b64decode(enc64)
-  
-  # Hash password to appropriate size key
-  pwdbytes = pwd.encode('utf-8')
-  key = kdf(nacl.secret.SecretBox.KEY_SIZE, pwdbytes)
-
-  # Decrypt
-  box = nacl.secret.SecretBox(key)
-  zipd = box.decrypt(zipd)
-  
-  # Ungzip
-  contents = zlib.decompress(zipd)
-  
-  return contents
+  # Read file, then decrypt & ungzip
+  with open(fname, 'rb') as f:
+    return crypto.decrypt(f.read(), pwd)
 
 # ---------------------------------------------------------------------------
 
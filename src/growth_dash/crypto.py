@@ -0,0 +1,188 @@
+"""
+Encryption of source data files. Shared by the growth-dash script and the dashboard.
+
+Current files are laid out as:
+
+  FILE_HEADER | salt | SecretBox nonce + ciphertext of zlib compressed data
+
+where the key is derived from the password and salt with Argon2id. Older files have no
+header, are keyed with a single BLAKE2b hash of the password, and may be base64 encoded.
+"""
+
+import functools
+import hashlib
+import io
+import re
+import zlib
+import nacl.exceptions
+import nacl.secret
+import nacl.utils
+from argon2.low_level import hash_secret_raw, Type
+
+# pybase64 is a SIMD accelerated drop-in replacement for the base64 module
+try:
+  import pybase64 as base64
+except ImportError:
+  import base64
+
+# Marks files encrypted with an Argon2id derived key. Starts with a 0 byte, which can't appear in base64 text.
+FILE_HEADER = b'\x00GDE\x01'
+SALT_SIZE = 16
+
+# Argon2id parameters (RFC 9106 recommendations for interactive use with 64 MiB memory)
+ARGON2_TIME_COST = 2
+ARGON2_MEMORY_COST = 64 * 1024 # KiB
+ARGON2_PARALLELISM = 1
+
+# Approximate size of decompressed source data relative to compressed size
+EXPECTED_COMPRESSION_RATIO = 4
+
+# Amount of compressed data fed to zlib at a time when streaming with open_decrypted()
+INFLATE_CHUNK_SIZE = 64 * 1024
+
+# Older encrypted files are base64 text. Others are binary, which starts with a header or random nonce.
+BASE64_PREFIX_RE = re.compile(rb'[A-Za-z0-9+/=\r\n]+')
+
+def derive_key(pwd, salt):
+  """
+  Generate key from password and salt with Argon2id. This is deliberately slow.
+  """
+  return hash_secret_raw(
+    pwd,
+    salt,
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=ARGON2_PARALLELISM,
+    hash_len=nacl.secret.SecretBox.KEY_SIZE,
+    type=Type.ID)
+
+@functools.lru_cache(maxsize=4)
+def kdf(pwd, salt):
+  """
+  derive_key() for decryption. Results are cached since the same file is usually decrypted repeatedly.
+
+  encrypt() calls derive_key() directly, since every new salt would only push a reusable key out of the cache.
+  """
+  return derive_key(pwd, salt)
+
+def legacy_kdf(pwd):
+  """
+  Generate key from password for files without FILE_HEADER.
+
+  Matches nacl.hash.blake2b() used by older versions: the key is the first KEY_SIZE characters
+  of the hex encoded digest.
+  """
+  size = nacl.secret.SecretBox.KEY_SIZE
+  return hashlib.blake2b(pwd, digest_size=size).hexdigest().encode('ascii')[:size]
+
+def is_base64(contents):
+  """ Guess whether contents is base64 text by checking that its first bytes are all in the base64 alphabet """
+  return BASE64_PREFIX_RE.fullmatch(contents[:64]) is not None
+
+def encrypt(contents, pwd):
+  """
+  Compress and encrypt bytes, contents, with a password. Returns the encrypted bytes.
+  """
+  # Gzip
+  zipd = zlib.compress(contents)
+
+  # Derive key from password and a new random salt
+  salt = nacl.utils.random(SALT_SIZE)
+  key = derive_key(pwd.encode('utf-8'), salt)
+
+  # Encrypt
+  box = nacl.secret.SecretBox(key)
+  enc = box.encrypt(zipd)
+  del zipd
+
+  return FILE_HEADER + salt + enc
+
+def decrypt_zipped(contents, pwd):
+  """
+  Decrypt bytes, contents, created by encrypt() or older versions of the growth-dash script,
+  and return the still compressed data. If pwd is None, contents are assumed to be compressed,
+  but not encrypted.
+  """
+
+  if contents.startswith(FILE_HEADER):
+    # Split out salt, nonce, and ciphertext. Passing the nonce separately avoids another copy of the ciphertext in SecretBox.
+    salt_start = len(FILE_HEADER)
+    nonce_start = salt_start + SALT_SIZE
+    data_start = nonce_start + nacl.secret.SecretBox.NONCE_SIZE
+    salt = contents[salt_start:nonce_start]
+    nonce = contents[nonce_start:data_start]
+    decoded = contents[data_start:]
+
+    # Decrypt. These files are always encrypted, so a password is required.
+    if pwd is None:
+      raise nacl.exceptions.CryptoError('Password required to decrypt data')
+    box = nacl.secret.SecretBox(kdf(pwd.encode('utf-8'), salt))
+    zipd = box.decrypt(decoded, nonce)
+
+  else:
+    # Base 64 decode older files
+    if is_base64(contents):
+      decoded = base64.b64decode(contents)
+    else:
+      decoded = contents
+
+    # Try to decrypt if a password was provided
+    if pwd is not None:
+      box = nacl.secret.SecretBox(legacy_kdf(pwd.encode('utf-8')))
+      zipd = box.decrypt(decoded)
+    else:
+      zipd = decoded
+
+  return zipd
+
+def decrypt(contents, pwd):
+  """
+  Decrypt and decompress bytes, contents, created by encrypt(). See decrypt_zipped().
+  """
+  zipd = decrypt_zipped(contents, pwd)
+
+  # Ungzip. Size the output buffer up front for typical CSV compression so it isn't repeatedly grown and copied.
+  return zlib.decompress(zipd, bufsize=len(zipd) * EXPECTED_COMPRESSION_RATIO)
+
+def open_decrypted(contents, pwd):
+  """
+  Decrypt bytes, contents, created by encrypt(), and return a binary file object that
+  decompresses the data as it is read. See decrypt_zipped().
+
+  Handing this to a parser, e.g. pd.read_csv(), avoids ever holding the entire decompressed data in memory.
+  """
+  zipd = decrypt_zipped(contents, pwd)
+
+  return io.BufferedReader(InflateReader(zipd), buffer_size=INFLATE_CHUNK_SIZE * EXPECTED_COMPRESSION_RATIO)
+
+class InflateReader(io.RawIOBase):
+  """
+  Read-only raw file object over zlib compressed bytes, which are decompressed incrementally as they are read
+  """
+
+  def __init__(self, zipd):
+    self._zipd = memoryview(zipd)
+    self._pos = 0
+    self._inflater = zlib.decompressobj()
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    # Decompress at most len(b) bytes, feeding zlib the input left over from the last call or the next chunk.
+    # Loop since zlib may consume input without producing any output yet.
+    while not self._inflater.eof:
+      if self._inflater.unconsumed_tail:
+        chunk = self._inflater.unconsumed_tail
+      else:
+        chunk = self._zipd[self._pos:self._pos + INFLATE_CHUNK_SIZE]
+        self._pos += len(chunk)
+        if len(chunk) == 0:
+          raise zlib.error('Compressed data is incomplete or truncated')
+
+      out = self._inflater.decompress(chunk, len(b))
+      if out:
+        b[:len(out)] = out
+        return len(out)
+
+    return 0
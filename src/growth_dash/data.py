@@ -1,30 +1,54 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import io
 import requests
-import nacl.secret
-import nacl.hash
+import pyarrow as pa
+import pyarrow.csv as pv
+import nacl.exceptions
 import zlib
-import base64
+import glob
+import hashlib
+import io
+import os
 import logging
 
 from dataclasses import dataclass
+from pprint import pformat
+
+from . import __version__
+from .crypto import open_decrypted, encrypt, decrypt
 
 DAYS_PER_MONTH=30.4375
+NS_PER_DAY=24 * 60 * 60 * 10**9
+
+# Parsed source data is cached on disk here, so restarting the app doesn't have to decrypt and parse it again
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'growth_dash')
+
+# Columns in source data file
+SOURCE_COLUMNS = ['MRN', 'Name', 'DOB', 'Metric', 'Val', 'TS', 'Row', 'Misc']
+
+# Columns to load from source data file and their types. Metric only has a few distinct values, so it
+# is dictionary encoded (becomes a pandas Categorical). Dates are read as text and parsed by parse().
+SOURCE_COLUMN_TYPES = {
+  'MRN': pa.int64(),
+  'DOB': pa.string(),
+  'Metric': pa.dictionary(pa.int32(), pa.string()),
+  'Val': pa.float32(),
+  'TS': pa.string()
+}
 
 @dataclass
 class GrowthData:
   """
-  Patient data.
+  Patient data. Data frames are sorted and indexed by MRN.
   - df: the full data set imported from the source file
   - wt: all weight measurements
   - ht: all height measurements
-  - hc: all head circumference measurements
   - mrns: list of all unique MRNs in the data set
   """
   df: pd.DataFrame
   wt: pd.DataFrame
+  ht: pd.DataFrame
   mrns: list
 
 def fetch(url):
@@ -32,7 +56,7 @@ def fetch(url):
 
   # Try to read as local file if url doesn't start with http
   if not url.lower().startswith('http'):
-    with open(url, 'r') as f:
+    with open(url, 'rb') as f:
       return f.read()
   
   # Read as URL
@@ -42,56 +66,95 @@ def fetch(url):
     resp.raise_for_status()
     return resp.content
 
-def kdf(size, pwd):
-  """ Generate appropriate sized key from password """
-  return nacl.hash.blake2b(pwd, digest_size=size)[:size]
-
-def decrypt(contents, pwd):
-  """ Decrypt encrypted string, which should be gzipped, encrypted with pynacl, and base64 encoded. """
+def parse(f):
+  """
+  Use pyarrow's multithreaded CSV reader to create a pandas data frame from CSV data in
+  binary file object, f, since the rest of our program uses pandas to manipulate data
+  """
+  table = pv.read_csv(
+    f,
+    
+    # skip the header row and use our own column names in SOURCE_COLUMNS
+    read_options=pv.ReadOptions(skip_rows=1, column_names=SOURCE_COLUMNS),
+    
+    # return only the columns we want with explicit types, rather than inferring them
+    convert_options=pv.ConvertOptions(column_types=SOURCE_COLUMN_TYPES, include_columns=list(SOURCE_COLUMN_TYPES)))
   
-  # Base 64 decode
-  decoded = base64.b64decode(contents)
+  # Convert to pandas. self_destruct frees each Arrow column as it is converted so the data isn't held twice.
+  df = table.to_pandas(split_blocks=True, self_destruct=True)
+  del table
   
-  # Try to decrypt if a password was provided
-  if pwd is not None:
-    # Hash password to appropriate size key
-    pwdbytes = pwd.encode('utf-8')
-    key = kdf(nacl.secret.SecretBox.KEY_SIZE, pwdbytes)
+  # Columns with datetime data to parse. Format varies by data source, so let pandas infer it.
+  for col in ['DOB', 'TS']:
+    df[col] = pd.to_datetime(df[col], infer_datetime_format=True)
   
-    # Decrypt
-    box = nacl.secret.SecretBox(key)
-    zipd = box.decrypt(decoded)
+  return df
 
-  else:
-    zipd = decoded
-    
-  
-  # Ungzip
-  unzipped = zlib.decompress(zipd)
-  
-  return unzipped
+def cache_file(src, contents):
+  """
+  Return path of the disk cache file for source data, contents, fetched from src. Files are named
+  <source hash>-<data hash>.feather.enc. The data hash covers the source data and the package version, so changed
+  data or a new version of the parser never reuses a stale file. The source hash keeps caches for different
+  sources apart.
+  """
+  src_hash = hashlib.blake2b(src.encode('utf-8'), digest_size=8)
+  h = hashlib.blake2b(contents, digest_size=16)
+  h.update(__version__.encode('ascii'))
+  return os.path.join(CACHE_DIR, src_hash.hexdigest() + '-' + h.hexdigest() + '.feather.enc')
 
-def parse(byts):
+def read_cache(fname, pwd):
   """
-  Use pandas.read_csv() to create a data frame from CSV data since the rest of our
-  program uses pandas to manipulate data
+  Return data frame stored by write_cache() in file, fname, or None if it doesn't exist or can't be read.
+  A cache file that can't be decrypted is ignored, so the source data decides whether pwd is incorrect.
   """
-  return pd.read_csv(
-    # Wrap byte array in stream (stackoverflow.com/questions/22604564/create-pandas-dataframe-from-a-string)
-    io.BytesIO(byts),
-    
-    # explicitly specify first row is a header row, then overwrite contents
-    # with our own column names in names[]
-    header=0,
-    names=['MRN', 'Name', 'DOB', 'Metric', 'Val', 'TS', 'Row', 'Misc'],
-    
-    # Columns with datetime data to parse
-    parse_dates=['DOB', 'TS'],
-    infer_datetime_format=True,
-    
-    # return only the columns we want
-    usecols=['MRN', 'DOB', 'Metric', 'Val', 'TS']
-  )
+  try:
+    with open(fname, 'rb') as f:
+      contents = f.read()
+    return pd.read_feather(io.BytesIO(decrypt(contents, pwd)))
+  except FileNotFoundError:
+    return None
+  except (OSError, nacl.exceptions.CryptoError, zlib.error, pa.ArrowException) as e:
+    logging.warning(str(e) + ' while reading data cache file ' + fname)
+    return None
+
+def write_cache(fname, df, pwd):
+  """
+  Store data frame, df, in file, fname, in Arrow IPC (feather) format. The file is encrypted with the same
+  password as the source data, so decrypted data is never on disk in plain text. If pwd is None, the source
+  data wasn't encrypted, and neither is the cache file. Errors are logged, since the cache is optional.
+  
+  Other cache files for the same source are removed once fname is written, so copies of older source data don't
+  accumulate on disk.
+  """
+  buf = io.BytesIO()
+  df.to_feather(buf, compression='uncompressed')
+  contents = buf.getvalue()
+  del buf
+  
+  # encrypt() compresses the data itself, so feather compression is off above
+  contents = encrypt(contents, pwd) if pwd is not None else zlib.compress(contents)
+  
+  # Write to a temporary file first, so a partially written cache file is never read. The name is unique to this
+  # process, since another dashboard process may be writing the same file.
+  tmpname = '{}.{}.tmp'.format(fname, os.getpid())
+  try:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(tmpname, 'wb') as f:
+      f.write(contents)
+    os.replace(tmpname, fname)
+  except OSError as e:
+    logging.warning(str(e) + ' while writing data cache file ' + fname)
+    return
+  
+  # Remove files cached for the same source with older source data or package versions. Files for other sources,
+  # and temporary files that other processes may still be writing, are left alone.
+  src_hash = os.path.basename(fname).split('-', 1)[0]
+  for other in glob.glob(os.path.join(CACHE_DIR, src_hash + '-*.feather.enc')):
+    if other != fname:
+      try:
+        os.remove(other)
+      except OSError as e:
+        logging.warning(str(e) + ' while removing old data cache file ' + other)
 
 # Use allow_output_mutation to avoid hashing return value to improve performance
 @st.cache(allow_output_mutation=True)
@@ -106,19 +169,35 @@ def load_data(src, pwd=None):
   
   # Fetch source data URL
   contents = fetch(src)
-
-  # Decrypt
+  fname = cache_file(src, contents)
+  
   try:
-    decrypted_bytes = decrypt(contents, pwd)
+    # Use data parsed by a previous run if it was cached on disk
+    df = read_cache(fname, pwd)
+    if df is not None:
+      return df
+    
+    # Decrypt and parse text data into pandas data frame. Data is decompressed as it is parsed, so the full
+    # plain text is never in memory.
+    df = parse(open_decrypted(contents, pwd))
   except (nacl.exceptions.CryptoError, zlib.error) as e:
     logging.warn(str(e) + ' while decrypting source data. Assuming incorrect password.', exc_info=True)
     raise ValueError('Incorrect password') from e
   
-  # Parse text data into pandas data frame
-  df = parse(decrypted_bytes)
-
+  write_cache(fname, df, pwd)
   return df
 
+def metric_rows(df, metric):
+  """
+  Return boolean mask of rows in df with measurement type, metric. Metric is a categorical
+  column, so this compares its integer codes rather than every string.
+  """
+  categories = df['Metric'].cat.categories
+  if metric not in categories:
+    return np.zeros(len(df), dtype=bool)
+  
+  return df['Metric'].cat.codes.values == categories.get_loc(metric)
+
 # Use allow_output_mutation to avoid hashing return value to improve performance
 @st.cache(allow_output_mutation=True, show_spinner=False)
 def transform(df):
@@ -131,28 +210,45 @@ def transform(df):
       'df': entire filtered data set,
       'wt': weight measurements,
       'ht': height measurements,
-      'hc': head circumference measurements,
       'mrns': unique MRNs
     }
   """
   
-  # Copy original data frame, sorted by MRN
-  df = df.sort_values(by='MRN', ignore_index=True)
+  # Copy original data frame, sorted by MRN. MRN is made categorical first, so sorting here and
+  # grouping by patient below work on small integer codes instead of hashing every value.
+  mrn = df['MRN'].astype('category')
+  order = np.argsort(mrn.cat.codes.values, kind='stable')
+  df = df.take(order)
+  df.reset_index(drop=True, inplace=True)
+  df['MRN'] = mrn.values.take(order)
 
-  # Precalculate age in months for each measurement
-  df['Age'] = (
-    (df['TS'] - df['DOB']).dt.days / DAYS_PER_MONTH
-  ).round(2)
+  # Precalculate age in months for each measurement. Works on the raw datetime64[ns] arrays: whole
+  # days elapsed (same as .dt.days) by integer division, then scaled to months and rounded to 2 places.
+  # Stored as float32, which is plenty for ages to 2 decimal places and halves the column's memory.
+  elapsed = df['TS'].values - df['DOB'].values
+  has_age = ~np.isnat(elapsed)
+  days = elapsed.view('i8') // NS_PER_DAY
+  df['Age'] = np.where(has_age, np.round(days / DAYS_PER_MONTH, 2), np.nan).astype(np.float32)
   
-  # Remove rows for measurements taken after 2 yo
-  df = df.loc[df['Age'] < 24.5]
+  # Remove rows for measurements taken after 2 yo. Compare whole days, which is equivalent
+  # to comparing the rounded age in months to 24.5.
+  df = df.loc[has_age & (days < 24.5 * DAYS_PER_MONTH)]
+  
+  # Label rows by MRN, so a patient's rows can be selected with df.loc[mrn:mrn]. Rows are sorted by MRN,
+  # so pandas does this with a binary search rather than comparing every row.
+  df.index = np.asarray(df['MRN'])
 
-  # Build a dataframe with info for each unique patient MRN
-  ptinfo = df.groupby(['MRN']).agg({
-    'TS': 'min', # time stamp of the first visit
-    'Sex': 'first',
-    'DOB': 'first'
-  })
+  # Build a dataframe with info for each unique patient MRN. Rows are sorted by MRN, so each
+  # patient's rows are contiguous and start wherever the MRN code changes.
+  codes = df['MRN'].cat.codes.values
+  first_idx = np.flatnonzero(np.diff(codes, prepend=-1))
+  ts = df['TS'].values
+  ptinfo = pd.DataFrame(
+    {
+      'TS': np.minimum.reduceat(ts, first_idx) if len(first_idx) else ts[:0], # time stamp of the first visit
+      'DOB': df['DOB'].values[first_idx]
+    },
+    index=pd.Index(df['MRN'].values[first_idx], name='MRN'))
   
   # Calculate each patient's age in months
   now = np.datetime64('today')
@@ -161,14 +257,15 @@ def transform(df):
   
   
   # Filter specific measurements types
-  wtdata = df.loc[df['Metric'] == 'Weight Measured']
-  htdata = df.loc[df['Metric'] == 'Height/Length Measured']
+  wtdata = df.loc[metric_rows(df, 'Weight Measured')]
+  htdata = df.loc[metric_rows(df, 'Height/Length Measured')]
   
-  # Get list of unique MRNs
-  mrns = ptinfo.index.unique().tolist()
+  # Get list of unique MRNs. ptinfo has one row per patient, sorted by MRN.
+  mrns = ptinfo.index.tolist()
   
   return GrowthData(
     df=df,
     wt=wtdata,
+    ht=htdata,
     mrns=mrns
   )
\ No newline at end of file
@@ -1,13 +1,15 @@
 from .constants import *
-from .gc_stats import init, get_percentile_lines, percentile, zscore
+from .gc_stats import init, get_percentile_lines, get_percentile_lines_long, percentile, zscore, percentiles_for
 
 # Call init to load data files
 init()
 
 __all__ = [
   get_percentile_lines,
+  get_percentile_lines_long,
   percentile,
   zscore,
+  percentiles_for,
   
   # Constants
   GC_HEIGHT_OLSEN,
@@ -0,0 +1,79 @@
+"""
+Kernels that apply the LMS formulas to whole arrays of LMS parameters at once.
+
+When numba is installed, these are compiled loops that write into a preallocated output array.
+Otherwise, numpy broadcasting versions with the same signatures are used.
+"""
+
+import numpy as np
+
+from .core import njit, HAVE_NUMBA
+
+def _lms_percentiles_batch_numpy(L, M, S, Z, out):
+  if M.shape != L.shape or S.shape != L.shape or out.shape != (L.shape[0], Z.shape[0]):
+    raise ValueError('LMS parameters and output must have matching shapes')
+  # Per row terms are calculated once as columns, then broadcast against the row of Z-scores. L=0 is
+  # substituted with 1 in the exponent so the unused branch of np.where() doesn't divide by 0.
+  nonzero = (L != 0)[:, None]
+  invL = (1 / np.where(L != 0, L, 1))[:, None]
+  LS = (L * S)[:, None]
+  M = M[:, None]
+  S = S[:, None]
+  out[...] = np.where(
+    nonzero,
+    M * np.power(1 + LS * Z, invL),
+    M * np.exp(S * Z))
+  return out
+
+def _lms_zscores_batch_numpy(L, M, S, vals, out):
+  if L.shape != vals.shape or M.shape != vals.shape or S.shape != vals.shape or out.shape != vals.shape:
+    raise ValueError('LMS parameters, values, and output must have the same shape')
+  # L=0 is substituted with 1 in the denominator so the unused branch of np.where() doesn't divide by 0
+  out[...] = np.where(
+    L != 0,
+    (np.power(vals / M, L) - 1) / (np.where(L != 0, L, 1) * S),
+    np.log(vals / M) / S)
+  return out
+
+if not HAVE_NUMBA:
+  lms_percentiles_batch = _lms_percentiles_batch_numpy
+  lms_zscores_batch = _lms_zscores_batch_numpy
+
+else:
+  @njit(cache=True, fastmath=True)
+  def lms_percentiles_batch(L, M, S, Z, out):
+    """
+    Apply zscore_to_x() to each row of LMS parameters, (L[i], M[i], S[i]), and each Z-score, Z[j].
+    Results are written to out[i, j], which must have shape (len(L), len(Z)). Returns out.
+    """
+    # numba doesn't check bounds, so mismatched arrays would be read or written past their ends
+    if M.shape != L.shape or S.shape != L.shape or out.shape != (L.shape[0], Z.shape[0]):
+      raise ValueError('LMS parameters and output must have matching shapes')
+    for i in range(L.shape[0]):
+      # Terms that only depend on the row are calculated once, which leaves no division in the inner loop
+      if L[i] != 0:
+        invL = 1 / L[i]
+        LS = L[i] * S[i]
+        for j in range(Z.shape[0]):
+          out[i, j] = M[i] * (1 + LS * Z[j]) ** invL
+      else:
+        for j in range(Z.shape[0]):
+          out[i, j] = M[i] * np.exp(S[i] * Z[j])
+    return out
+
+  # No fastmath, which assumes there are no NaNs. LMS parameters are NaN for values beyond the bounds of a growth chart.
+  @njit(cache=True)
+  def lms_zscores_batch(L, M, S, vals, out):
+    """
+    Apply x_to_zscore() to each value, vals[i], with its LMS parameters, (L[i], M[i], S[i]).
+    Results are written to out[i], which must have the same length as vals. Returns out.
+    """
+    # numba doesn't check bounds, so mismatched arrays would be read or written past their ends
+    if L.shape != vals.shape or M.shape != vals.shape or S.shape != vals.shape or out.shape != vals.shape:
+      raise ValueError('LMS parameters, values, and output must have the same shape')
+    for i in range(vals.shape[0]):
+      if L[i] != 0:
+        out[i] = ((vals[i] / M[i]) ** L[i] - 1) / (L[i] * S[i])
+      else:
+        out[i] = np.log(vals[i] / M[i]) / S[i]
+    return out
@@ -18,5 +18,5 @@ GC_WFL_WHO='WHO_WFL'
 MALE='male'
 FEMALE='female'
   
-# Standard percentile lines for growth charts
-DEFAULT_PERCENTILES = [3,10,25,50,75,90,97]
\ No newline at end of file
+# Standard percentile lines for growth charts. A tuple, so it can be used as a cache key as is.
+DEFAULT_PERCENTILES = (3,10,25,50,75,90,97)
\ No newline at end of file
@@ -3,31 +3,48 @@ General statistics functions
 """
 
 import math
-
-def weighted_avg(a, b, weight):
-  """
-  Find number between a and b at fractional distance given by weight between [0, 1].
-  """
-  return b * weight + a * (1 - weight)
-
-def erf(x):
-  """
-  Error function implementation derived from codeproject.com/Articles/408214/Excel-Function-NORMSDIST-z
-  
-  If Y is normally distributed with mean=0 and variance=1/2 => erf(x) is probability that Y falls in [-x, x].
-  """
-
-  # Constants for A&S formula 7.1.26
-  a1 =  0.254829592
-  a2 = -0.284496736
-  a3 =  1.421413741
-  a4 = -1.453152027
-  a5 =  1.061405429
-  p  =  0.3275911
-  t = 1.0/(1.0 + p*abs(x))
-
-  # Approximation using Horner's method. Takes O(n) operations for nth order polynomial.
-  return 1.0 - (((((a5*t + a4)*t) + a3)*t + a2)*t + a1) * t * math.exp(-x*x)
+import numpy as np
+
+# Use scipy's C implementations of the normal distribution functions. Pure Python fallbacks below are used if scipy is not installed.
+try:
+  from scipy.special import ndtr, ndtri
+except ImportError:
+  ndtr = ndtri = None
+
+# Compile kernels to native code with numba when it is installed. Otherwise, they run as plain Python.
+# Modules with numpy versions of their kernels can check HAVE_NUMBA to use those instead.
+try:
+  from numba import njit
+  HAVE_NUMBA = True
+except ImportError:
+  HAVE_NUMBA = False
+  def njit(*args, **kwargs):
+    """
+    Stand-in for numba.njit that returns the decorated function unchanged
+    """
+    if len(args) == 1 and callable(args[0]):
+      return args[0]
+    return lambda f: f
+
+# Coefficients in rational approximations for _normsinv_fallback()
+NORMSINV_A = np.array([-3.969683028665376e+01, 2.209460984245205e+02,
+  -2.759285104469687e+02, 1.383577518672690e+02,
+  -3.066479806614716e+01, 2.506628277459239e+00])
+
+NORMSINV_B = np.array([-5.447609879822406e+01, 1.615858368580409e+02,
+  -1.556989798598866e+02, 6.680131188771972e+01,
+  -1.328068155288572e+01])
+
+NORMSINV_C = np.array([-7.784894002430293e-03, -3.223964580411365e-01,
+  -2.400758277161838e+00, -2.549732539343734e+00,
+  4.374664141464968e+00, 2.938163982698783e+00])
+
+NORMSINV_D = np.array([7.784695709041462e-03, 3.224671290700398e-01,
+  2.445134137142996e+00, 3.754408661907416e+00])
+
+# Break-points between the lower, central, and upper regions in _normsinv_fallback()
+NORMSINV_PLOW = 0.02425
+NORMSINV_PHIGH = 1 - NORMSINV_PLOW
 
 def normsinv(p):
   """
@@ -35,6 +52,16 @@ def normsinv(p):
     
     normsinv: (0,1) -> (-inf,+inf)
   
+  Uses scipy.special.ndtri, so p may be a single value or a numpy array.
+  """
+  if ndtri is None:
+    return _normsinv_fallback(p)
+  return ndtri(p)
+
+def _normsinv_fallback(p):
+  """
+  normsinv() for when scipy is not installed.
+  
   Ported from JS library by Peter John Acklam (home.online.no/~pjacklam), timestamp 2003-05-05 05:15:14
   
   Lower tail quantile for standard normal distribution function.
@@ -49,42 +76,32 @@ def normsinv(p):
   than 1.15e-9.
 
   An algorithm with a relative error less than 1.15*10-9 in the entire region.
-  """
-
-  # Coefficients in rational approximations
-  a = [-3.969683028665376e+01, 2.209460984245205e+02,
-    -2.759285104469687e+02, 1.383577518672690e+02,
-    -3.066479806614716e+01, 2.506628277459239e+00]
 
-  b = [-5.447609879822406e+01, 1.615858368580409e+02,
-    -1.556989798598866e+02, 6.680131188771972e+01,
-    -1.328068155288572e+01]
-
-  c = [-7.784894002430293e-03, -3.223964580411365e-01,
-    -2.400758277161838e+00, -2.549732539343734e+00,
-    4.374664141464968e+00, 2.938163982698783e+00]
-
-  d = [7.784695709041462e-03, 3.224671290700398e-01,
-    2.445134137142996e+00, 3.754408661907416e+00]
-
-  # Define break-points.
-  plow = 0.02425
-  phigh = 1 - plow
+  Works on whole numpy arrays: every region's approximation is evaluated for all
+  elements and the right one is picked per element with np.select(), instead of branching.
+  """
 
-  # Rational approximation for lower region:
-  if (p < plow):
-    q = math.sqrt(-2 * math.log(p))
-    return (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1)
+  a = NORMSINV_A
+  b = NORMSINV_B
+  c = NORMSINV_C
+  d = NORMSINV_D
 
-  # Rational approximation for upper region:
-  if (phigh < p):
-    q = math.sqrt(-2 * math.log(1 - p))
-    return  - (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1)
+  p = np.asarray(p, dtype=np.float64)
+  lower = p < NORMSINV_PLOW
+  upper = NORMSINV_PHIGH < p
 
   # Rational approximation for central region:
   q = p - 0.5
   r = q * q
-  return (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q / (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1)
+  central = (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q / (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1)
+
+  # Rational approximation for lower region. The upper region is the same approximation applied to 1-p
+  # with the sign flipped. Central elements use 0.5, so they don't take the log of values near 0.
+  q = np.sqrt(-2 * np.log(np.where(lower, p, np.where(upper, 1 - p, 0.5))))
+  tail = (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1)
+
+  # Index with () to return a scalar instead of a 0-d array when p is a single value
+  return np.select([lower, upper], [tail, -tail], central)[()]
 
 def normsdist(z):
   """
@@ -93,12 +110,23 @@ def normsdist(z):
     normsdist: (-inf,+inf) -> (0,1)
     
   Return probability that the observed value of a standard normal random variable will be less than or equal to z.
-    
-  Derived from codeproject.com/Articles/408214/Excel-Function-NORMSDIST-z
+  
+  Uses scipy.special.ndtr, so z may be a single value or a numpy array.
   """
-  sign = z / abs(z)
-  return 0.5 * (1.0 + sign * Math.erf(abs(z)/Math.sqrt(2)))
+  if ndtr is None:
+    return _normsdist_fallback(z)
+  return ndtr(z)
+
+# math.erf() applied elementwise, so _normsdist_fallback() also accepts numpy arrays
+_erf = np.vectorize(math.erf, otypes=[np.float64])
 
+def _normsdist_fallback(z):
+  """
+  normsdist() for when scipy is not installed.
+  """
+  return 0.5 * (1.0 + _erf(np.asarray(z) / math.sqrt(2)))
+
+@njit(cache=True, fastmath=True)
 def zscore_to_x(Z, L, M, S):
   """
   Adapted from Nikolai Schwertner, MedAppTech (2012-11-28)
@@ -118,8 +146,11 @@ def zscore_to_x(Z, L, M, S):
   if L != 0:
     return M * math.pow(1 + L * S * Z, 1 / L)
   else:
-    return M * Math.exp(S * Z)
+    return M * math.exp(S * Z)
 
+# No fastmath, which assumes there are no NaNs. Measurements may be missing (NaN), and interpolated LMS parameters
+# are NaN beyond the bounds of a growth chart.
+@njit(cache=True)
 def x_to_zscore(x, L, M, S):
   """
   Adapted from Nikolai Schwertner, MedAppTech (2012-11-28)
@@ -137,9 +168,9 @@ def x_to_zscore(x, L, M, S):
   """
 
   if L != 0:
-    return (Math.pow(X/M, L) - 1) / (L * S)
+    return (math.pow(x/M, L) - 1) / (L * S)
   else:
-    return Math.log(X/M) / S
+    return math.log(x/M) / S
 
 def percentile_to_x(percentile, L, M, S):
   """
@@ -150,9 +181,12 @@ def percentile_to_x(percentile, L, M, S):
   return zscore_to_x(Z, L, M, S)
 
 def x_to_percentile(x, L, M, S):
+  """
+  Given a data value and corresponding LMS parameters, return its percentile between [0, 100].
+  """
   Z = x_to_zscore(x, L, M, S)
-  return normsdist(Z)
+  return normsdist(Z) * 100
   
 def x_to_zscore_and_percentile(x, L, M, S):
   Z = x_to_zscore(x, L, M, S)
-  return (Z, normsdist(Z))
+  return (Z, normsdist(Z) * 100)
@@ -1,9 +1,19 @@
+import functools
+import itertools
+import operator
 import os
-import json
+import numpy as np
 import pandas as pd
 
+# orjson is a faster drop-in replacement for parsing JSON
+try:
+  import orjson as json
+except ImportError:
+  import json
+
 from .constants import *
 from .core import *
+from ._kernels import lms_percentiles_batch, lms_zscores_batch
 
 # Master LMS data for all growth chart types
 GC_DATA = None
@@ -27,56 +37,129 @@ def get_lms_table(gc_type, sex):
   
   return GC_DATA[gc_type]['data'][sex]
 
-def get_lms_for_x(LMS_table, x):
+def get_lms_arrays(gc_type, sex):
   """
-  Given the LMS_table table of LMS parameters, in the format:
-    
+  Given a growth chart type, gc_type, and sex, return the LMS lookup table
+  as a single array with rows (x, L, M, S), built by init() from GC_DATA
+  """
+  if (gc_type not in GC_DATA) or (sex not in GC_DATA[gc_type]['arrays']):
+    return None
+  
+  return GC_DATA[gc_type]['arrays'][sex]
+
+def lms_table_to_arrays(LMS_table):
+  """
+  Convert an LMS table in the format:
+  
     [
       {'x': 23, 'L': 0.0, 'M': 0.0, 'S': 0.0},
       {'x': 24, 'L': 1.0, 'M': 2.0, 'S': 3.0},
       ...
     ]
   
+  To a single contiguous (4, n) numpy array with a row for each of x, L, M, and S:
+  
+    [[23,  24,  ...],
+     [0.0, 1.0, ...],
+     [0.0, 2.0, ...],
+     [0.0, 3.0, ...]]
+  
+  Each row is contiguous in memory, and the array unpacks like a tuple: xs, L, M, S = LMS_arrays
+  """
+  # Read all values in a single pass over the table, then transpose so each parameter's values are contiguous
+  values = itertools.chain.from_iterable(map(operator.itemgetter('x', 'L', 'M', 'S'), LMS_table))
+  rows = np.fromiter(values, dtype=np.float64, count=4 * len(LMS_table)).reshape(-1, 4)
+  return np.ascontiguousarray(rows.T)
+
+def get_lms_for_x(LMS_arrays, x):
+  """
+  Given the LMS_arrays array of LMS parameters with rows (x, L, M, S), from get_lms_arrays(), in the format:
+    
+    [[23,  24,  ...],
+     [0.0, 1.0, ...],
+     [0.0, 2.0, ...],
+     [0.0, 3.0, ...]]
+  
   Where x is usually the age in months, except for weight-for-length, where x is length,
   
   Return LMS parameters for arbitrary x value by interpolating data points.
   
-  Return value only contains the LMS values. Using the table above, for x=23.5
+  Return value only contains the LMS values, as a tuple (L, M, S). Using the table above, for x=23.5
   
-    { 'L': 0.5, 'M': 1.0, 'S', 1.5 }
+    (0.5, 1.0, 1.5)
   
   Returns None if x is beyond bounds of table (e.g. x < youngest age or x > oldest age)
     
   """
+  xs, L, M, S = LMS_arrays
 
-  n = len(LMS_table)
+  # Binary search for the first row with x value >= x. Table is sorted by x.
+  i = np.searchsorted(xs, x)
+  if (i == len(xs)) or (i == 0 and x != xs[0]):
+    return None
 
-  for i in range(0, n):
-    if x == LMS_table[i]['x']:
-      # Return exact age matches
-      return {
-        'L': LMS_table[i]['L'],
-        'M': LMS_table[i]['M'],
-        'S': LMS_table[i]['S']
-      }
-    elif (i < n-1) and (x > LMS_table[i]['x']) and (x <= LMS_table[i+1]['x']):
-      # If we are in between data points, interpolate neighboring LMS parameters
-      weight = (x - LMS_table[i]['x']) / (LMS_table[i+1]['x'] - LMS_table[i]['x'])
-      return {
-        'L': weighted_avg(LMS_table[i]['L'], LMS_table[i+1]['L'], weight),
-        'M': weighted_avg(LMS_table[i]['M'], LMS_table[i+1]['M'], weight),
-        'S': weighted_avg(LMS_table[i]['S'], LMS_table[i+1]['S'], weight)
-      }
+  if x == xs[i]:
+    # Return exact age matches
+    return L[i], M[i], S[i]
 
-  return None
+  # If we are in between data points, interpolate neighboring LMS parameters
+  weight = (x - xs[i-1]) / (xs[i] - xs[i-1])
+  return (
+    L[i-1] + (L[i] - L[i-1]) * weight,
+    M[i-1] + (M[i] - M[i-1]) * weight,
+    S[i-1] + (S[i] - S[i-1]) * weight
+  )
 
-def lms_to_percentiles(LMS_table, percentiles):
+def get_lms_for_xs(LMS_arrays, xs):
   """
-  Convert:
+  Batch version of get_lms_for_x(). Given an array of x values, xs, return interpolated
+  LMS parameters for each value as a tuple of arrays:
+  
+    (L, M, S)
+  
+  Elements for x values beyond bounds of table are NaN.
+  """
+  table_xs, L, M, S = LMS_arrays
+  xs = np.asarray(xs, dtype=np.float64)
+
+  # Index of the first row with x value >= each x. Clip so that rows i-1 and i always exist,
+  # which handles x equal to the first row with weight=0.
+  i = np.clip(np.searchsorted(table_xs, xs), 1, len(table_xs) - 1)
+  prev = i - 1
+  weight = (xs - table_xs[prev]) / (table_xs[i] - table_xs[prev])
+  weight = np.where((xs >= table_xs[0]) & (xs <= table_xs[-1]), weight, np.nan)
+
+  # Interpolate each parameter as p0 + (p1 - p0) * weight. Reuse the difference array
+  # for the result, so no other temporary arrays are allocated.
+  LMS = []
+  for param in (L, M, S):
+    p0 = param[prev]
+    out = param[i] - p0
+    np.multiply(out, weight, out=out)
+    np.add(out, p0, out=out)
+    LMS.append(out)
+
+  return tuple(LMS)
+
+@functools.lru_cache(maxsize=None)
+def percentiles_to_zscores(percentiles):
+  """
+  Return Z-scores for a tuple of percentiles between [0, 100] as a read-only numpy array.
+
+  Cached, since the same few sets of percentiles are converted every time percentile lines are calculated.
+  """
+  Z = normsinv(np.asarray(percentiles, dtype=np.float64) / 100)
+  Z.setflags(write=False)
+  return Z
+
+def lms_to_percentiles(LMS_arrays, percentiles, dtype=np.float64):
+  """
+  Convert the LMS_arrays array of LMS parameters with rows (x, L, M, S), from get_lms_arrays(), and a list of percentiles:
  
-   [{"x": 23, L: 0.0, M: 0.0, S: 0.0},
-    {"x": 24, L: ...},
-    ...],
+   [[23,  24,  ...],
+    [0.0, 1.0, ...],
+    [0.0, 2.0, ...],
+    [0.0, 3.0, ...]],
    [5, 10, ...]
  
   To a pandas data frame with a column for each desired percentile:
@@ -85,32 +168,61 @@ def lms_to_percentiles(LMS_table, percentiles):
      23: value at 5%,  value at 10%, value at 15%, ...
      24: ...,
    }
+  
+  Values are stored as dtype, e.g. np.float32 to halve memory for data only used for plotting.
   """
   
-  # Iterate over row in LMS table (each row contains LMS params at a given age), change:
-  #   {"x": 23, L: 0.0, M: 0.0, S: 0.0},
-  #     to
-  #   {23: [val-at-5%, val-at-10%, ...]}
-  rows = {
-    row['x']: [percentile_to_x(p, row['L'], row['M'], row['S']) for p in percentiles]
-    for row in LMS_table
-  }
+  xs, L, M, S = LMS_arrays
+  Z = percentiles_to_zscores(tuple(percentiles))
+  
+  # Apply zscore_to_x() to every (row, percentile) pair at once, giving a 2D array:
+  #   [[val-at-5%, val-at-10%, ...],   <- row for x=23
+  #    [val-at-5%, val-at-10%, ...],   <- row for x=24
+  #    ...]
+  # Values are written straight into a Fortran order array, which keeps the values for each percentile
+  # contiguous, so pandas uses it without copying.
+  vals = lms_percentiles_batch(L, M, S, Z, np.empty((len(xs), len(Z)), dtype=dtype, order='F'))
   
-  # Convert to pandas data frame:
-  # - orient='index' to treat each key in rows as a row, not column
-  # - use percentiles as the column names
-  return pd.DataFrame.from_dict(rows, orient='index', columns=percentiles)
+  # Convert to pandas data frame using x values as row labels and percentiles as the column names
+  return pd.DataFrame(vals, index=xs, columns=percentiles)
 
-_percentile_cache = {}
-def load_percentile_cache(gc_data, gc_types):
+# Percentile lines are only used for plotting, so store them at single precision
+PERCENTILE_LINES_DTYPE = np.float32
+
+@functools.lru_cache(maxsize=64)
+def _cached_percentile_lines(gc_type, sex, percentiles):
   """
-  Precalculate and cache percentile curves for a list of growth chart types, gc_types
+  get_percentile_lines() for a tuple of percentiles. Each set of percentile lines is calculated on first use, then cached.
   """
-  for gc_type in gc_types:
-    _percentile_cache[gc_type] = {
-      MALE: lms_to_percentiles(gc_data[gc_type]['data'][MALE], DEFAULT_PERCENTILES),
-      FEMALE: lms_to_percentiles(gc_data[gc_type]['data'][FEMALE], DEFAULT_PERCENTILES)
-    }
+  return lms_to_percentiles(get_lms_arrays(gc_type, sex), percentiles, PERCENTILE_LINES_DTYPE)
+
+@functools.lru_cache(maxsize=64)
+def _cached_percentile_lines_long(gc_type, sex, percentiles):
+  """
+  get_percentile_lines_long() for a tuple of percentiles. Each set of percentile lines is calculated on first use, then cached.
+  """
+  lines = _cached_percentile_lines(gc_type, sex, percentiles)
+  xs = lines.index.values
+  
+  # Build the long form columns directly from arrays instead of melt(). The x values repeat once per percentile,
+  # and the values of each percentile line are contiguous in the wide data frame, so they flatten in column order.
+  # Like the wide form, everything is stored compactly since it is only used for plotting: x values at single
+  # precision and the percentile labels as a categorical, which holds each label once plus small integer codes.
+  return pd.DataFrame({
+    'index': np.tile(xs.astype(PERCENTILE_LINES_DTYPE), len(percentiles)),
+    'key': pd.Categorical.from_codes(
+      np.repeat(np.arange(len(lines.columns), dtype=np.int8), len(xs)),
+      categories=[str(p) for p in lines.columns]),
+    'value': lines.to_numpy().ravel(order='F')
+  })
+
+def load_gc_data(fname):
+  """
+  Load LMS data sets from JSON file, fname. The file is read in a single call and parsed
+  from bytes, which skips decoding it to text first and is what orjson expects.
+  """
+  with open(fname, 'rb') as f:
+    return json.loads(f.read())
 
 # =========================================================================
 # Public interface
@@ -125,12 +237,13 @@ def init():
   if GC_DATA is not None:
     return
   
-  with open(GCCURVEDATA_FILE, 'r') as f:
-    GC_DATA = json.load(f)
+  GC_DATA = load_gc_data(GCCURVEDATA_FILE)
   
-  # Precalculate default percentiles for the most common growth charts
-  load_percentile_cache(GC_DATA, [
-    GC_WEIGHT_WHO, GC_HEIGHT_WHO, GC_WFL_WHO])
+  # Convert each LMS table to a contiguous array for fast lookups by x
+  for gc_type in GC_DATA:
+    GC_DATA[gc_type]['arrays'] = {
+      sex: lms_table_to_arrays(LMS_table) for sex, LMS_table in GC_DATA[gc_type]['data'].items()
+    }
   
   return GC_DATA
 
@@ -138,7 +251,7 @@ def get_percentile_lines(gc_type, sex, percentiles=DEFAULT_PERCENTILES):
   """
   Return percentile lines for a given growth chart type and sex.
   
-  Return value is a pandas data frame with a column for each percentile:
+  Return value is a pandas data frame of float32 values with a column for each percentile:
  
                5           10             15        ...
      age: value at 5%,  value at 10%, value at 15%, ...
@@ -149,24 +262,60 @@ def get_percentile_lines(gc_type, sex, percentiles=DEFAULT_PERCENTILES):
   
       gc_stats.get_percentile_lines(gc_stats.GC_WHO_WEIGHT, gc_stats.MALE, [5,25,50,75,95])
   """
-  LMS_table = get_lms_table(gc_type, sex)
-  if LMS_table is None:
+  if get_lms_arrays(gc_type, sex) is None:
     return {}
   
-  # If percentile lines were precalculated for this chart type, return that copy
-  if (percentiles == DEFAULT_PERCENTILES) and (gc_type in _percentile_cache):
-    return _percentile_cache[gc_type][sex]
+  # Cache by value of percentiles, so repeated calls with an equal list, e.g. on every dashboard rerun, reuse the same lines.
+  # DEFAULT_PERCENTILES is already a tuple, so it is used as is.
+  if percentiles is not DEFAULT_PERCENTILES:
+    percentiles = tuple(percentiles)
+  return _cached_percentile_lines(gc_type, sex, percentiles)
+
+def get_percentile_lines_long(gc_type, sex, percentiles=DEFAULT_PERCENTILES):
+  """
+  Return percentile lines for a given growth chart type and sex in long form, with one row per point on each line.
+  
+  Return value is a pandas data frame with columns 'index' (age), 'key' (percentile as a categorical string), and 'value':
   
-  return lms_to_percentiles(LMS_table, percentiles)
+     index key value
+      0    3   2.5
+      1    3   3.4
+      ...
+      0    10  2.8
+      ...
+  
+  This is the same format as altair's transform_fold() applied to get_percentile_lines().reset_index(),
+  so charts can use it directly without transforming the data on every render.
+  """
+  if get_lms_arrays(gc_type, sex) is None:
+    return {}
+  
+  if percentiles is not DEFAULT_PERCENTILES:
+    percentiles = tuple(percentiles)
+  return _cached_percentile_lines_long(gc_type, sex, percentiles)
+
+def get_lms(gc_type, sex, x):
+  """
+  Return interpolated LMS parameters, (L, M, S), at x on a growth chart, or None if x is
+  beyond bounds of the chart or the chart doesn't exist.
+  """
+  LMS_arrays = get_lms_arrays(gc_type, sex)
+  if LMS_arrays is None:
+    return None
+
+  return get_lms_for_x(LMS_arrays, x)
 
 def percentile(gc_type, sex, x, val):
   """
-  Return the percentile of a given value on a growth chart
+  Return the percentile, between [0, 100], of a given value on a growth chart
   
   x is usually the age in months. For weight-for-length, x is length.
   """
-  Z, percentile = zscore_percentile(gc_type, sex, x, val)
-  return percentile
+  LMS = get_lms(gc_type, sex, x)
+  if LMS is None:
+    return None
+
+  return x_to_percentile(val, *LMS)
 
 def zscore(gc_type, sex, x, val):
   """
@@ -174,19 +323,43 @@ def zscore(gc_type, sex, x, val):
 
   x is usually the age in months. For weight-for-length, x is length.
   """
-  Z, percentile = zscore_percentile(gc_type, sex, x, val)
-  return Z
+  LMS = get_lms(gc_type, sex, x)
+  if LMS is None:
+    return None
+
+  return x_to_zscore(val, *LMS)
   
 def zscore_percentile(gc_type, sex, x, val):
   """
-  Return both z-score and percentile of a given value on a growth chart
+  Return both z-score and percentile, between [0, 100], of a given value on a growth chart
   
   x is usually the age in months. For weight-for-length, x is length.
   """
-  LMS_table = get_lms_table(gc_type, sex)
-  if LMS_table is None:
+  LMS = get_lms(gc_type, sex, x)
+  if LMS is None:
     return None, None
 
-  LMS = get_lms_for_x(LMS_table, x)
-  return x_to_zscore_and_percentile(val, LMS['L'], LMS['M'], LMS['S'])
-  
\ No newline at end of file
+  return x_to_zscore_and_percentile(val, *LMS)
+  
+
+def percentiles_for(gc_type, sex, xs, vals):
+  """
+  Return the percentile, between [0, 100], of many values on a growth chart at once, as a numpy array.
+  
+  xs and vals are equal length arrays or pandas columns, e.g. df['Age'] and df['Val']. Raises ValueError if their shapes differ.
+  Percentiles are NaN where x is beyond bounds of the growth chart.
+  """
+  LMS_arrays = get_lms_arrays(gc_type, sex)
+  if LMS_arrays is None:
+    return None
+
+  xs = np.asarray(xs, dtype=np.float64)
+  vals = np.asarray(vals, dtype=np.float64)
+  if xs.shape != vals.shape:
+    raise ValueError('xs and vals must have the same shape, got ' + str(xs.shape) + ' and ' + str(vals.shape))
+
+  L, M, S = get_lms_for_xs(LMS_arrays, xs)
+
+  # Apply x_to_zscore() to every value at once
+  Z = lms_zscores_batch(L, M, S, vals, np.empty_like(vals))
+  return normsdist(Z) * 100
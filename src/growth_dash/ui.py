@@ -1,14 +1,40 @@
 import streamlit as st
 import html
 import base64
+import functools
 import pandas as pd
-import altair as alt
 from . import gc_stats as gc
 from .data import load_data, transform
 
 # Entire preprocessed source data set
 DATA = None
 
+# Hash data frames by identity for st.cache. Data frames passed to or referenced by cached functions come
+# from the cached transform() and are not modified, so this skips hashing every row on each rerun.
+CACHE_HASH_FUNCS = {pd.DataFrame: id}
+
+# Column with each weight's percentile on the WHO boys chart. Source data has no sex, so the label says which chart
+# the percentile is for, rather than implying it is the patient's own percentile.
+WT_PERCENTILE_COL = 'WHO boys %ile'
+
+@functools.lru_cache(maxsize=8)
+def decode_pwd(pwd_b64):
+  """
+  Decode base 64 encoded password from URL. Returns None if it is not valid.
+  Cached since the same password is decoded on every rerun.
+  """
+  try:
+    return base64.b64decode(pwd_b64).decode('ascii')
+  except ValueError:
+    return None
+
+@functools.lru_cache(maxsize=8)
+def encode_pwd(pwd):
+  """
+  Base 64 encode password for URL. Inverse of decode_pwd().
+  """
+  return base64.b64encode(pwd.encode('ascii')).decode('ascii')
+
 def ensure_src_data_loaded():
   """
   Get source data file location from URL and try to load/decrypt it.
@@ -23,10 +49,7 @@ def ensure_src_data_loaded():
   
   # Password in URL is base 64 encoded
   if pwd_qp:
-    try:
-      pwd_qp = base64.b64decode(pwd_qp).decode('ascii')
-    except:
-      pwd_qp = None
+    pwd_qp = decode_pwd(pwd_qp)
   
   # Error if no source data file specified
   if src_qp is None:
@@ -46,7 +69,7 @@ def ensure_src_data_loaded():
 
   # Update URL to include current password
   if pwd:
-    qps['pwd'] = base64.b64encode(pwd.encode('ascii')).decode('ascii')
+    qps['pwd'] = encode_pwd(pwd)
     st.experimental_set_query_params(**qps)
   
   # Fetch/decrypt data
@@ -64,41 +87,46 @@ def ensure_src_data_loaded():
 
   return data
   
-@st.cache
+# Use allow_output_mutation to avoid hashing return value to improve performance
+@st.cache(hash_funcs=CACHE_HASH_FUNCS, allow_output_mutation=True, show_spinner=False)
 def get_wt_data(mrn):
   # Use mrn:mrn to slice, resulting in always getting a DataFrame, not a Series, even if only 1 data point
-  return DATA.wt.loc[mrn:mrn]
+  ptwt = DATA.wt.loc[mrn:mrn]
+  
+  # Add percentile of each measurement on the plotted WHO boys chart, calculated for all measurements at once
+  return ptwt.assign(**{WT_PERCENTILE_COL: gc.percentiles_for(gc.GC_WEIGHT_WHO, gc.MALE, ptwt['Age'], ptwt['Val'])})
 
-@st.cache
+@st.cache(hash_funcs=CACHE_HASH_FUNCS, allow_output_mutation=True, show_spinner=False)
 def quantiles_per_month(data, quantiles):
   """
   Calculate the values at the given quantiles for each month of age in data.
   
   data - a dataframe with column 'Age' = age in months, and 'Val' = measurement
-  quantiles - list of quantiles to calculate as % between 0-100 (e.g [25, 50, 75])
+  quantiles - tuple of quantiles to calculate as % between 0-100 (e.g (25, 50, 75))
   """
   # Round ages to the nearest whole month
   month_bin = data['Age'].round()
-  quantiles_by_month = {}
-  for month in range(int(month_bin.max())+1):
-    # Grab all weights (Val column) measured on month of age
-    data_for_month = data.loc[month_bin==month, 'Val']
-    
-    # Calculate values at each percentile for this month
-    quantiles_by_month[month] = [data_for_month.quantile(q / 100) for q in quantiles]
   
-  # Convert {1: [3.0, 3.6, ...], 2: [...]} to DataFrame:
+  # Calculate values (Val column) at each quantile for all months in one grouped pass, then pivot
+  # quantiles to columns. Months without any measurements are NaN.
   #
-  #      3   10   25  ...
-  #   0: 1.7 2.2  ...
-  #   1: 1.4 2.3  ...
+  #      Agg3 Agg10 Agg25  ...
+  #   0: 1.7  2.2   ...
+  #   1: 1.4  2.3   ...
   #   ...
   #
-  return pd.DataFrame.from_dict(quantiles_by_month, orient='index', columns=['Agg' + str(q) for q in quantiles])
+  qs = [q / 100 for q in quantiles]
+  quantiles_by_month = data['Val'].groupby(month_bin).quantile(qs).unstack()[qs]
+  quantiles_by_month.columns = ['Agg' + str(q) for q in quantiles]
+  quantiles_by_month.index.name = None
+  return quantiles_by_month.reindex(range(int(month_bin.max())+1))
   
 def run():
   global DATA
 
+  # Import altair here, rather than at module level, since it is a heavy import only needed to draw charts
+  import altair as alt
+
   # Global configuration
   title = 'Growth Data Dashboard'
   st.set_page_config(
@@ -116,27 +144,26 @@ def run():
   mrns = DATA.mrns
   wtdata = DATA.wt
 
-  # Load growth chart data
-  who_weight_m_percentiles = gc.get_percentile_lines(gc.GC_WEIGHT_WHO, gc.MALE)
+  # Load growth chart data in long form (columns index, key, value), which is cached by gc_stats across reruns
+  who_weight_m_percentiles = gc.get_percentile_lines_long(gc.GC_WEIGHT_WHO, gc.MALE)
 
   # Set up weight charts
-  percentiles = ['3', '10', '25', '50', '75', '90', '97']
   line_colors = [
     ['3', '10', '25', '50', '75', '90', '97', 'Agg3', 'Agg50', 'Agg97'],
     ['palegoldenrod', 'palegoldenrod', 'palegoldenrod', 'palegoldenrod', 'palegoldenrod', 'palegoldenrod', 'palegoldenrod', 'lightblue', 'lightblue', 'lightblue']
   ]
   weight_encoding = {
     'x': alt.X(
-      field='index',                            # 'index' column created by reset_index() above
+      field='index',                            # 'index' column from get_percentile_lines_long() for WHO lines, or reset_index() below for aggregate lines
       type='quantitative',                      # quantitative = continuous real value (altair-viz.github.io/user_guide/encoding.html#encoding-data-types)
       axis=alt.Axis(
         title='Age (months)')),
     'y': alt.Y(
-      field='value',                            # 'value' column created by transform_fold() above
+      field='value',                            # 'value' column from get_percentile_lines_long() or transform_fold() below
       type='quantitative',
       axis=alt.Axis(title='Weight (kg)')),
     'color': alt.Color(                         # define multiple lines
-      field='key',                              # - 'key' column created by transform_fold() above
+      field='key',                              # - 'key' column from get_percentile_lines_long() or transform_fold() below
       type='nominal',                           # - nominal = discrete unordered category
       legend=None,                              # - disable legend. we'll make our own labels directly on the lines using another chart.
       scale=alt.Scale(
@@ -144,18 +171,12 @@ def run():
         range=line_colors[1]))
   }
   gc_weight_m = (
-    alt.Chart(who_weight_m_percentiles.reset_index())      # reset_index() converts row labels (age in months) to its own column
-      .transform_fold(percentiles)                             # transform_fold: convert wide-form to long-form (altair-viz.github.io/user_guide/data.html#data-long-vs-wide)
-                                       # eg. index 5   10  25         index key value
-                                                #     1 mo  5.0 6.0 7.0   ->   1 mo  5   5.0
-                                                #     2 mo  5.2 6.2 7.2        1 mo  10  6.0
-                                                #                              1 mo  25  7.0
-                                                #                              ...
-      .mark_line()                                  # Make a line plot
-      .encode(**weight_encoding))                                     # Configure chart visual (map visual properties to data columns, altair-viz.github.io/user_guide/encoding.html)
+    alt.Chart(who_weight_m_percentiles)                     # already long-form, so no reset_index() or transform_fold() needed
+      .mark_line()                                          # Make a line plot
+      .encode(**weight_encoding))                           # Configure chart visual (map visual properties to data columns, altair-viz.github.io/user_guide/encoding.html)
   
   # Build percentile lines for aggregate data
-  agg_wt_quantiles = quantiles_per_month(wtdata, [3, 50, 97])
+  agg_wt_quantiles = quantiles_per_month(wtdata, (3, 50, 97))
 
   ct_agg_wt = (
     alt.Chart(agg_wt_quantiles.reset_index())
@@ -176,7 +197,7 @@ def run():
   ).encode(
     x='Age:Q',
     y='Val:Q',
-    tooltip=['Age', 'Val']
+    tooltip=['Age', 'Val', alt.Tooltip(WT_PERCENTILE_COL, type='quantitative', format='.1f')]
   )
 
   # Sidebar
@@ -203,4 +224,4 @@ def run():
       col1, col2, _ = st.beta_columns(3)
       col1.write('MRN: ' + str(mrn))
       col2.write('DOB: ' + ptwt.iloc[0]['DOB'].strftime('%D'))
-      st.write(ptwt[['Age', 'Val', 'TS']])
\ No newline at end of file
+      st.write(ptwt[['Age', 'Val', WT_PERCENTILE_COL, 'TS']])
\ No newline at end of file
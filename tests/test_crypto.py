@@ -0,0 +1,88 @@
+import base64
+import io
+import os
+import zlib
+
+import nacl.exceptions
+import nacl.hash
+import nacl.secret
+import pytest
+
+from growth_dash import crypto
+
+PWD = 'secret'
+
+# CSV-like text, with random hex so the compressed data spans several of open_decrypted()'s input chunks
+DATA = b''.join(b'%d,%s\n' % (i, os.urandom(16).hex().encode('ascii')) for i in range(10000))
+
+def legacy_encrypt(contents, pwd):
+  """
+  Encrypt the way the growth-dash script did before FILE_HEADER was added: key from a single BLAKE2b hash of
+  the password (nacl.hash.blake2b returns hex, so the key is the first KEY_SIZE hex characters), without base 64.
+  """
+  size = nacl.secret.SecretBox.KEY_SIZE
+  key = nacl.hash.blake2b(pwd.encode('utf-8'), digest_size=size)[:size]
+  return nacl.secret.SecretBox(key).encrypt(zlib.compress(contents))
+
+def test_round_trip():
+  enc = crypto.encrypt(DATA, PWD)
+  assert enc.startswith(crypto.FILE_HEADER)
+  assert crypto.decrypt(enc, PWD) == DATA
+
+def test_encrypt_doesnt_cache_keys():
+  # Each encrypt() uses a new salt, so its key would never be reused from the cache
+  crypto.kdf.cache_clear()
+  enc = crypto.encrypt(DATA, PWD)
+  assert crypto.kdf.cache_info().currsize == 0
+  crypto.decrypt(enc, PWD)
+  crypto.decrypt(enc, PWD)
+  assert crypto.kdf.cache_info().hits == 1
+
+def test_legacy_base64():
+  enc = base64.b64encode(legacy_encrypt(DATA, PWD))
+  assert crypto.decrypt(enc, PWD) == DATA
+
+def test_legacy_raw():
+  enc = legacy_encrypt(DATA, PWD)
+  assert crypto.decrypt(enc, PWD) == DATA
+
+@pytest.mark.parametrize('enc', [
+  crypto.encrypt(DATA, PWD),
+  base64.b64encode(legacy_encrypt(DATA, PWD)),
+  legacy_encrypt(DATA, PWD)
+], ids=['header', 'legacy_base64', 'legacy_raw'])
+def test_wrong_password(enc):
+  with pytest.raises(nacl.exceptions.CryptoError):
+    crypto.decrypt(enc, 'wrong')
+
+def test_missing_password():
+  with pytest.raises(nacl.exceptions.CryptoError):
+    crypto.decrypt(crypto.encrypt(DATA, PWD), None)
+
+def test_unencrypted_without_password():
+  assert crypto.decrypt(zlib.compress(DATA), None) == DATA
+
+@pytest.mark.parametrize('size', [1, 7, 4096])
+def test_open_decrypted_small_reads(size):
+  enc = crypto.encrypt(DATA, PWD)
+  f = crypto.open_decrypted(enc, PWD)
+  chunks = iter(lambda: f.read(size), b'')
+  assert b''.join(chunks) == crypto.decrypt(enc, PWD)
+
+def test_open_decrypted_raw_reads():
+  # Read the unbuffered InflateReader directly with a small buffer
+  reader = crypto.InflateReader(zlib.compress(DATA))
+  out = io.BytesIO()
+  buf = bytearray(10)
+  while True:
+    n = reader.readinto(buf)
+    if n == 0:
+      break
+    out.write(buf[:n])
+  assert out.getvalue() == DATA
+
+def test_open_decrypted_truncated():
+  zipd = zlib.compress(DATA)
+  f = crypto.open_decrypted(zipd[:len(zipd) // 2], None)
+  with pytest.raises(zlib.error):
+    f.read()
@@ -0,0 +1,126 @@
+import math
+
+import numpy as np
+import pytest
+from scipy.special import ndtr
+from scipy.stats import norm
+
+from growth_dash import gc_stats as gc
+from growth_dash.gc_stats import _kernels
+from growth_dash.gc_stats.core import HAVE_NUMBA
+from growth_dash.gc_stats.gc_stats import get_lms_arrays
+
+# numpy versions are always available. The numba versions are the module's kernels when numba is installed.
+PERCENTILES_KERNELS = [pytest.param(_kernels._lms_percentiles_batch_numpy, id='numpy')]
+ZSCORES_KERNELS = [pytest.param(_kernels._lms_zscores_batch_numpy, id='numpy')]
+if HAVE_NUMBA:
+  PERCENTILES_KERNELS.append(pytest.param(_kernels.lms_percentiles_batch, id='numba'))
+  ZSCORES_KERNELS.append(pytest.param(_kernels.lms_zscores_batch, id='numba'))
+
+def lms_params():
+  """ LMS parameters from a real growth chart, plus rows with L=0, which use the log/exp form of the formulas """
+  _, L, M, S = get_lms_arrays(gc.GC_WEIGHT_WHO, gc.MALE)
+  L = np.append(L, [0.0, 0.0])
+  M = np.append(M, [3.5, 10.0])
+  S = np.append(S, [0.12, 0.1])
+  return L, M, S
+
+def scalar_x(z, L, M, S):
+  return M * math.exp(S * z) if L == 0 else M * (1 + L * S * z) ** (1 / L)
+
+def scalar_zscore(x, L, M, S):
+  return math.log(x / M) / S if L == 0 else ((x / M) ** L - 1) / (L * S)
+
+@pytest.mark.parametrize('kernel', PERCENTILES_KERNELS)
+def test_lms_percentiles_batch(kernel):
+  L, M, S = lms_params()
+  percentiles = (1, 3, 10, 50, 90, 97, 99)
+  Z = np.array([norm.ppf(p / 100) for p in percentiles])
+
+  out = kernel(L, M, S, Z, np.empty((len(L), len(Z))))
+  expected = np.array([[scalar_x(z, L[i], M[i], S[i]) for z in Z] for i in range(len(L))])
+  np.testing.assert_allclose(out, expected, rtol=1e-7)
+
+@pytest.mark.parametrize('kernel', ZSCORES_KERNELS)
+def test_lms_zscores_batch(kernel):
+  L, M, S = lms_params()
+  vals = M * np.random.default_rng(0).uniform(0.6, 1.6, len(M))
+
+  out = kernel(L, M, S, vals, np.empty_like(vals))
+  expected = np.array([scalar_zscore(vals[i], L[i], M[i], S[i]) for i in range(len(vals))])
+  np.testing.assert_allclose(out, expected, rtol=1e-7)
+  np.testing.assert_allclose(ndtr(out), [norm.cdf(z) for z in expected], rtol=1e-7)
+
+@pytest.mark.skipif(not HAVE_NUMBA, reason='numba is not installed')
+def test_kernel_variants_match():
+  L, M, S = lms_params()
+  Z = gc.gc_stats.percentiles_to_zscores(gc.DEFAULT_PERCENTILES)
+  vals = M * np.random.default_rng(1).uniform(0.6, 1.6, len(M))
+
+  np.testing.assert_allclose(
+    _kernels.lms_percentiles_batch(L, M, S, Z, np.empty((len(L), len(Z)))),
+    _kernels._lms_percentiles_batch_numpy(L, M, S, Z, np.empty((len(L), len(Z)))),
+    rtol=1e-12)
+  np.testing.assert_allclose(
+    _kernels.lms_zscores_batch(L, M, S, vals, np.empty_like(vals)),
+    _kernels._lms_zscores_batch_numpy(L, M, S, vals, np.empty_like(vals)),
+    rtol=1e-12)
+
+@pytest.mark.parametrize('kernel', ZSCORES_KERNELS)
+def test_lms_zscores_batch_nan(kernel):
+  # LMS parameters are NaN beyond the bounds of a growth chart, and measurements may be missing
+  L, M, S = (np.array([1.0, np.nan, 1.0]), np.array([10.0, np.nan, 10.0]), np.array([0.1, np.nan, 0.1]))
+  vals = np.array([11.0, 11.0, np.nan])
+
+  out = kernel(L, M, S, vals, np.empty_like(vals))
+  np.testing.assert_allclose(out[0], 1.0)
+  assert np.isnan(out[1:]).all()
+
+@pytest.mark.parametrize('kernel', PERCENTILES_KERNELS)
+def test_lms_percentiles_batch_shape_mismatch(kernel):
+  L, M, S = lms_params()
+  Z = np.zeros(3)
+  with pytest.raises(ValueError):
+    kernel(L, M[:-1], S, Z, np.empty((len(L), len(Z))))
+  with pytest.raises(ValueError):
+    kernel(L, M, S, Z, np.empty((len(L), len(Z) + 1)))
+
+@pytest.mark.parametrize('kernel', ZSCORES_KERNELS)
+def test_lms_zscores_batch_shape_mismatch(kernel):
+  L, M, S = lms_params()
+  with pytest.raises(ValueError):
+    kernel(L, M, S, M[:-1], np.empty(len(M) - 1))
+  with pytest.raises(ValueError):
+    kernel(L, M, S, M, np.empty(len(M) - 1))
+
+def test_percentile_range():
+  # Values on the percentile lines are at those percentiles, between 0 and 100
+  lines = gc.get_percentile_lines(gc.GC_WEIGHT_WHO, gc.MALE, [3, 50, 97])
+  x = lines.index[10]
+  for p in (3, 50, 97):
+    val = float(lines.loc[x, p])
+    assert gc.percentile(gc.GC_WEIGHT_WHO, gc.MALE, x, val) == pytest.approx(p, rel=1e-5)
+    z, pct = gc.gc_stats.zscore_percentile(gc.GC_WEIGHT_WHO, gc.MALE, x, val)
+    assert pct == pytest.approx(p, rel=1e-5)
+    assert z == pytest.approx(norm.ppf(p / 100), abs=1e-5)
+
+def test_percentiles_for_matches_percentile():
+  table_xs, _, M, _ = get_lms_arrays(gc.GC_WEIGHT_WHO, gc.FEMALE)
+
+  # Exact table x values, values between them, and values beyond both ends of the chart
+  xs = np.concatenate([table_xs, (table_xs[:-1] + table_xs[1:]) / 2, [table_xs[0] - 1, table_xs[-1] + 1]])
+  vals = np.interp(xs, table_xs, M) * np.random.default_rng(2).uniform(0.7, 1.4, len(xs))
+
+  out = gc.percentiles_for(gc.GC_WEIGHT_WHO, gc.FEMALE, xs, vals)
+  expected = [gc.percentile(gc.GC_WEIGHT_WHO, gc.FEMALE, x, val) for x, val in zip(xs, vals)]
+  expected = np.array([np.nan if p is None else p for p in expected])
+  assert np.isnan(out[-2:]).all()
+  np.testing.assert_allclose(out, expected, rtol=1e-7, equal_nan=True)
+  assert ((out[:-2] > 0) & (out[:-2] < 100)).all()
+
+def test_percentiles_for_unknown_chart():
+  assert gc.percentiles_for('UNKNOWN', gc.MALE, [1.0], [1.0]) is None
+
+def test_percentiles_for_shape_mismatch():
+  with pytest.raises(ValueError):
+    gc.percentiles_for(gc.GC_WEIGHT_WHO, gc.MALE, [1.0, 2.0], [5.0])